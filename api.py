@@ -1,11 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from hubspot import Client
 import requests
 
-from invoice_input import InvoiceIdentifier, InvoiceInput, LineItemInput, SkuIdentifier
+from invoice_input import InvoiceIdentifier, InvoiceInput, LineItemInput, LineItemUpdate, SkuIdentifier
 
 SEASONS_API = 'https://my.firstinspires.org/usfirstapi/seasons/search'
 
+BATCH_LIMIT = 100  # HubSpot caps batch read/update inputs per call
+
+BATCH_WORKERS = 4  # Concurrent batch calls, kept well under the per-second rate limit
+
+# Unique-value company property holding the team domain, so companies can be batch-read instead of searched
+COMPANY_DOMAIN_PROPERTY = 'team_domain'
+
+LINE_ITEM_PROPERTIES = ['quantity', 'hs_product_id', 'description', 'hs_sku', 'amount']
+
+INVOICE_PROPERTIES = ['hs_invoice_status', 'hs_due_date']
+
+DRAFT_INVOICE_STATUS = 'draft'
+FINALIZED_INVOICE_STATUS = 'open'
+
+
+def batches(values: list, size: int = BATCH_LIMIT) -> list[list]:
+    '''Split the values into consecutive chunks no larger than a single batch call accepts'''
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
 
 def fetch_first_seasons() -> dict[str, int]:
     '''Get the current seasons for all FIRST programs'''
@@ -66,9 +87,30 @@ def get_contact_ids(client: Client, emails: set[str]) -> dict[str, int]:
     return results
 
 
-def get_company_ids(client: Client, domains: set[str]) -> dict[str, int]:
-    '''Using the company domains, find the Company IDs'''
-    print('Asking HubSpot for Company IDs...')
+def read_company_ids(client: Client, domains: set[str]) -> dict[str, int]:
+    '''Using the unique team domain property, batch-read the Company IDs'''
+    results: dict[str, int] = {}
+    try:
+        for chunk in batches(domains):
+            api_response = client.crm.companies.batch_api.read(
+                batch_read_input_simple_public_object_id={
+                    'idProperty': COMPANY_DOMAIN_PROPERTY,
+                    'properties': [COMPANY_DOMAIN_PROPERTY],
+                    'inputs': [{'id': x} for x in chunk]
+                })
+            # Domains that do not exist come back as errors alongside the results, so only the results matter
+            results.update({x.properties[COMPANY_DOMAIN_PROPERTY]: int(
+                x.id) for x in api_response.results if not x.archived})
+    except Exception as e:
+        pprint(e)
+        print('Unable to read the Companies by', COMPANY_DOMAIN_PROPERTY,
+              'from HubSpot. Searching by domain instead')
+        results = {}
+    return results
+
+
+def search_company_ids(client: Client, domains: set[str]) -> dict[str, int]:
+    '''Using the company domains, search for the Company IDs'''
     body = {
         'filterGroups': [
             {
@@ -108,7 +150,22 @@ def get_company_ids(client: Client, domains: set[str]) -> dict[str, int]:
         print('One or more errors occurred when reading the Company lookup results')
         results = None
 
-    if results is None or len(results) == 0:
+    return results
+
+
+def get_company_ids(client: Client, domains: set[str]) -> dict[str, int]:
+    '''Using the company domains, find the Company IDs, searching only for those the batch read misses'''
+    print('Asking HubSpot for Company IDs...')
+    results = read_company_ids(client, domains)
+
+    unread_domains = domains.difference(set(results.keys()))
+    if unread_domains:
+        searched = search_company_ids(client, unread_domains)
+        if searched is None:
+            return None
+        results.update(searched)
+
+    if len(results) == 0:
         print('Could not find any Company')
         return None
 
@@ -238,22 +295,25 @@ def create_invoices(client: Client, invoice_values: list[InvoiceInput]) -> dict[
         print('One or more invoices was not generated. Please clear the records from HubSpot, check your data source, and try again')
         return None
 
-    associations_body = {
-        'inputs': [
-            {
-                'id': x
-            } for x in invoice_ids
-        ]
-    }
+    invoices = get_invoice_identifiers(client, invoice_ids)
+    if invoices is None:
+        return None
+
+    print('Generated', len(invoices), 'Invoices!')
+    return invoices
+
 
+def get_invoice_identifiers(client: Client, invoice_ids: set[int]) -> dict[InvoiceIdentifier, int]:
+    '''Using the contact and company associations, identify which invoice belongs to whom.'''
     invoice_to_contacts: dict[int, int] = {}
     try:
-        contact_result = client.crm.associations.batch_api.read(
-            '0-53', '0-1', batch_input_public_object_id=associations_body)
-        for result in contact_result.results:
-            values = result.to_dict()
-            invoice_to_contacts[int(values['_from']['id'])] = int(
-                values['to'][0]['id'])
+        for chunk in batches(invoice_ids):
+            contact_result = client.crm.associations.batch_api.read(
+                '0-53', '0-1', batch_input_public_object_id={'inputs': [{'id': x} for x in chunk]})
+            for result in contact_result.results:
+                values = result.to_dict()
+                invoice_to_contacts[int(values['_from']['id'])] = int(
+                    values['to'][0]['id'])
     except Exception as e:
         pprint(e)
         print('Unable to match contacts to invoices. Please clear the Invoices from HubSpot, check your data source, and try again')
@@ -265,12 +325,13 @@ def create_invoices(client: Client, invoice_values: list[InvoiceInput]) -> dict[
 
     invoice_to_companies: dict[int, int] = {}
     try:
-        company_result = client.crm.associations.batch_api.read(
-            '0-53', '0-2', batch_input_public_object_id=associations_body)
-        for result in company_result.results:
-            values = result.to_dict()
-            invoice_to_companies[int(values['_from']['id'])] = int(
-                values['to'][0]['id'])
+        for chunk in batches(invoice_ids):
+            company_result = client.crm.associations.batch_api.read(
+                '0-53', '0-2', batch_input_public_object_id={'inputs': [{'id': x} for x in chunk]})
+            for result in company_result.results:
+                values = result.to_dict()
+                invoice_to_companies[int(values['_from']['id'])] = int(
+                    values['to'][0]['id'])
     except Exception as e:
         pprint(e)
         print('Unable to match companies to invoices. Please clear the Invoices from HubSpot, check your data source, and try again')
@@ -289,7 +350,6 @@ def create_invoices(client: Client, invoice_values: list[InvoiceInput]) -> dict[
         associations_lookup[invoice_id] = InvoiceIdentifier(invoice_to_contacts[invoice_id],
                                                             invoice_to_companies[invoice_id])
 
-    print('Generated', len(associations_lookup), 'Invoices!')
     return {v: k for k, v in associations_lookup.items()}
 
 
@@ -364,3 +424,236 @@ def create_line_items(client: Client, line_items: list[LineItemInput], invoices:
 
     print('Line Items created and applied!')
     return line_item_ids
+
+
+def get_line_item_details(client: Client, line_item_ids: set[int], line_item_invoices: dict[int, int] = None) -> dict[int, dict]:
+    '''Read back the properties and invoice of each line item, only looking up the invoices not already known'''
+    print('Asking HubSpot for Line Item details...')
+    line_item_invoices = line_item_invoices or {}
+    details: dict[int, dict] = {}
+    try:
+        for chunk in batches(line_item_ids):
+            api_response = client.crm.line_items.batch_api.read(
+                batch_read_input_simple_public_object_id={
+                    'properties': LINE_ITEM_PROPERTIES,
+                    'inputs': [{'id': str(x)} for x in chunk]
+                })
+            for result in api_response.results:
+                details[int(result.id)] = dict(result.properties)
+
+            unknown = []
+            for x in chunk:
+                if x in line_item_invoices and x in details:
+                    details[x]['invoice'] = line_item_invoices[x]
+                else:
+                    unknown.append(x)
+            if len(unknown) == 0:
+                continue
+
+            association_result = client.crm.associations.batch_api.read(
+                '0-8', '0-53', batch_input_public_object_id={'inputs': [{'id': x} for x in unknown]})
+            for result in association_result.results:
+                values = result.to_dict()
+                details[int(values['_from']['id'])]['invoice'] = int(
+                    values['to'][0]['id'])
+    except Exception as e:
+        pprint(e)
+        print('Unable to read the Line Items from HubSpot')
+        return None
+
+    missing_ids = set(line_item_ids).difference(
+        set([k for k, v in details.items() if 'invoice' in v]))
+    if missing_ids:
+        print('One or more Line Items could not be read back with their Invoice:',
+              ', '.join([str(x) for x in missing_ids]))
+        return None
+
+    print('Retrieved Line Item details!')
+    return details
+
+
+def get_active_line_item_ids(client: Client, line_item_ids: set[int]) -> set[int]:
+    '''Find which of the line items still exist, unarchived, in HubSpot'''
+    print('Asking HubSpot which Line Items are still active...')
+    active: set[int] = set()
+    try:
+        for chunk in batches(line_item_ids):
+            api_response = client.crm.line_items.batch_api.read(
+                batch_read_input_simple_public_object_id={
+                    'properties': ['hs_object_id'],
+                    'inputs': [{'id': str(x)} for x in chunk]
+                })
+            # Line items that no longer exist come back as errors alongside the results, so only the results matter
+            active.update([int(x.id)
+                          for x in api_response.results if not x.archived])
+    except Exception as e:
+        pprint(e)
+        print('Unable to read the Line Items from HubSpot')
+        return None
+    return active
+
+
+def match_line_item_ids(client: Client, line_item_ids: set[int], line_items: list[LineItemInput], invoices: dict[InvoiceIdentifier, int], line_item_invoices: dict[int, int] = None) -> dict[int, LineItemInput]:
+    '''Pair each created line item ID with the input it was created from.'''
+    details = get_line_item_details(client, line_item_ids, line_item_invoices)
+    if details is None:
+        return None
+
+    # Identical lines on the same invoice are interchangeable, so queue them under one key
+    pending: dict[tuple, list[LineItemInput]] = {}
+    for x in line_items:
+        key = (invoices[x.invoice_identifier()], int(x.product),
+               int(x.quantity), str(x.description or ''))
+        pending.setdefault(key, []).append(x)
+
+    matches: dict[int, LineItemInput] = {}
+    try:
+        for line_item_id, values in details.items():
+            key = (values['invoice'], int(values['hs_product_id']), int(
+                float(values['quantity'])), str(values['description'] or ''))
+            matches[line_item_id] = pending[key].pop()
+    except:
+        print('One or more created Line Items did not match the spreadsheet rows')
+        return None
+
+    return matches
+
+
+def update_line_items(client: Client, updates: dict[int, LineItemUpdate]) -> set[int]:
+    '''Apply new quantities and descriptions to existing line items.'''
+    print('Asking HubSpot to update the Line Items...')
+    line_item_ids: set[int] = set()
+    for chunk in batches(updates.items()):
+        body = {
+            'inputs': [
+                {
+                    'id': str(line_item_id),
+                    'properties': {
+                        'quantity': x.quantity,
+                        'description': x.description
+                    }
+                }
+                for line_item_id, x
+                in chunk
+            ]
+        }
+
+        api_response = None
+        try:
+            api_response = client.crm.line_items.batch_api.update(
+                batch_input_simple_public_object_batch_input=body)
+        except Exception as e:
+            pprint(e)
+            print('Unable to update the Line Items in HubSpot')
+            api_response = None
+
+        if api_response is None:
+            return None
+        if hasattr(api_response, 'errors') or not hasattr(api_response, 'results'):
+            print('There were one or more errors associated with the Line Item UPDATE call')
+            pprint(api_response)
+            return None
+
+        line_item_ids.update([int(x.id) for x in api_response.results])
+
+    if len(line_item_ids) != len(updates):
+        print('One or more line items was not updated. Check the line items below in HubSpot:')
+        pprint(set(updates.keys()).difference(line_item_ids))
+        return None
+
+    print('Updated', len(line_item_ids), 'Line Items!')
+    return line_item_ids
+
+
+def finalize_invoices(client: Client, invoice_properties: dict[int, dict]) -> dict[int, bool]:
+    '''Move draft invoices to open, applying any other properties (e.g., due date) at the same time.'''
+    print('Asking HubSpot to finalize the Invoices...')
+
+    def update_batch(chunk: list[tuple[int, dict]]) -> set[int]:
+        body = {
+            'inputs': [
+                {
+                    'id': str(invoice_id),
+                    'properties': {
+                        **properties,
+                        'hs_invoice_status': FINALIZED_INVOICE_STATUS
+                    }
+                }
+                for invoice_id, properties
+                in chunk
+            ]
+        }
+
+        api_response = None
+        try:
+            api_response = client.crm.commerce.invoices.batch_api.update(
+                batch_input_simple_public_object_batch_input=body)
+        except Exception as e:
+            pprint(e)
+            print('Unable to finalize a batch of Invoices in HubSpot')
+            return set()
+
+        if hasattr(api_response, 'errors') and api_response.errors:
+            print('There were one or more errors associated with the Invoice UPDATE call')
+            pprint(api_response.errors)
+        if not hasattr(api_response, 'results'):
+            return set()
+        return set([int(x.id) for x in api_response.results])
+
+    finalized: set[int] = set()
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        for invoice_ids in executor.map(update_batch, batches(invoice_properties.items())):
+            finalized.update(invoice_ids)
+
+    results = {x: x in finalized for x in invoice_properties.keys()}
+    failed = [str(k) for k, v in results.items() if not v]
+    if failed:
+        print('One or more invoices could not be finalized and remain drafts:',
+              ', '.join(failed))
+
+    print('Finalized', len(finalized), 'of', len(results), 'Invoices!')
+    return results
+
+
+def get_invoice_line_item_ids(client: Client, invoice_ids: set[int]) -> dict[int, int]:
+    '''Find every line item currently applied to the invoices, mapped to its invoice'''
+    print('Asking HubSpot for the Line Items on each Invoice...')
+    line_item_invoices: dict[int, int] = {}
+    try:
+        for chunk in batches(invoice_ids):
+            association_result = client.crm.associations.batch_api.read(
+                '0-53', '0-8', batch_input_public_object_id={'inputs': [{'id': x} for x in chunk]})
+            for result in association_result.results:
+                values = result.to_dict()
+                for to in values['to']:
+                    line_item_invoices[int(to['id'])] = int(
+                        values['_from']['id'])
+    except Exception as e:
+        pprint(e)
+        print('Unable to match line items to invoices')
+        return None
+
+    print('Retrieved', len(line_item_invoices), 'Line Items!')
+    return line_item_invoices
+
+
+def get_invoice_details(client: Client, invoice_ids: set[int]) -> dict[int, dict]:
+    '''Read back the status and due date of each invoice'''
+    print('Asking HubSpot for Invoice details...')
+    details: dict[int, dict] = {}
+    try:
+        for chunk in batches(invoice_ids):
+            api_response = client.crm.commerce.invoices.batch_api.read(
+                batch_read_input_simple_public_object_id={
+                    'properties': INVOICE_PROPERTIES,
+                    'inputs': [{'id': str(x)} for x in chunk]
+                })
+            for result in api_response.results:
+                details[int(result.id)] = dict(result.properties)
+    except Exception as e:
+        pprint(e)
+        print('Unable to read the Invoices from HubSpot')
+        return None
+
+    print('Retrieved Invoice details!')
+    return details
@@ -2,12 +2,19 @@ from argparse import ArgumentParser
 import os
 from pprint import pprint
 from hubspot import Client
-from api import create_invoices, create_line_items, get_company_ids, get_contact_ids, get_product_ids
-from excel_import import CREATED_DATE_COL, DESCRIPTION_COL, DUE_DATE_COL, EMAIL_COL, PROGRAM_COL, QUANTITY_COL, SKU_COL, TEAM_NUMBER_COL, get_rows
-from invoice_input import COMPANY_DOMAIN_TEMPLATE, InvoiceEntryRow, LineItemInput, SkuIdentifier
+import pandas
+from api import DRAFT_INVOICE_STATUS, create_invoices, create_line_items, finalize_invoices, get_active_line_item_ids, get_company_ids, get_contact_ids, get_invoice_details, get_product_ids, match_line_item_ids, update_line_items
+from excel_import import CREATED_DATE_COL, DESCRIPTION_COL, DUE_DATE_COL, EMAIL_COL, PROGRAM_COL, QUANTITY_COL, SKU_COL, TEAM_NUMBER_COL, get_rows, merge_duplicate_rows
+from import_api import import_invoices
+from invoice_input import COMPANY_DOMAIN_TEMPLATE, InvoiceEntryRow, InvoiceIdentifier, LineItemInput, LineItemUpdate, SkuIdentifier
+from manifest import FINALIZED_KEY, INVOICE_ID_COL, INVOICE_KEY_COL, INVOICES_KEY, LINE_ITEM_ID_COL, MERGED_KEY, PRODUCT_ID_COL, add_row_keys, diff_rows, empty_manifest, get_manifest_path, get_removed_lines, load_manifest, prune_removed_lines, save_manifest, write_manifest
+from reconcile import reconcile
 
 TOKEN_PATH = './secrets/HUBSPOT_API_KEY'
 
+BATCH_BACKEND = 'batch'
+IMPORT_BACKEND = 'import'
+
 
 def get_hubspot_api_token() -> str:
     '''Extract token from secrets file.'''
@@ -20,78 +27,56 @@ def get_hubspot_api_token() -> str:
     return api_token if api_token is None else api_token.strip()
 
 
-def main(file_path: str):
-    '''Execute the sequence of steps to bulk-create invoices from the template spreadsheet.'''
-    if not os.path.isfile(file_path):
-        print('Provided file (', file_path, ') does not exist', sep='')
-        return
-
-    print('Beginning upload process...')
-
-    api_token = get_hubspot_api_token()
-    if api_token is None:
-        print('Could not retrieve HubSpot API token')
-        return
-
-    # 1. Parse all data in spreadsheet rows. Exit on error.
-    entries = get_rows(file_path)
-    if entries is None:
-        print('Unable to parse spreadsheet')
-        return
-
+def lookup_ids(api_client: Client, entries: pandas.DataFrame) -> tuple[dict[str, int], dict[str, int], dict[SkuIdentifier, int]]:
+    '''Find the HubSpot IDs of every contact, company, and product referenced by the rows.'''
     # Parse out the key identifiers
     email_addresses = set([str(x)
                           for x in entries[EMAIL_COL].astype(str).tolist()])
     if len(email_addresses) == 0:
         print('No emails provided')
-        return
+        return None
 
     team_domains = set([COMPANY_DOMAIN_TEMPLATE.format(x, y) for x, y in zip(
         entries[PROGRAM_COL].str.lower(), entries[TEAM_NUMBER_COL].astype(int).astype(str))])
     if len(team_domains) == 0:
         print('No team details provided')
-        return
+        return None
 
     product_skus = [entry for entry in set([SkuIdentifier(str(x), str(y)) for x, y in zip(
         entries[SKU_COL].astype(str), entries[PROGRAM_COL].astype(str))])]
     if len(product_skus) == 0:
         print('No product SKUs provided')
-        return
-
-    api_client = Client.create(access_token=api_token)
+        return None
 
     # 2. Lookup contact by emails. Exit on error.
     contacts = get_contact_ids(api_client, email_addresses)
     if contacts is None:
         print('Unable to lookup the requested contacts')
-        return
+        return None
 
     # 3. Lookup companies by domain. Exit on error.
     companies = get_company_ids(api_client, team_domains)
     if companies is None:
         print('Unable to lookup the requested companies')
-        return
+        return None
 
     # 4. Lookup products by SKU. Exit on error.
     products = get_product_ids(api_client, product_skus)
     if products is None:
         print('Unable to lookup the requested products')
-        return
+        return None
 
-    # 5. Create all invoices as drafts. Exit on error but report successes.
-    invoice_hubspot_values = set([
-        InvoiceEntryRow(program, team_number, email, created_date,
-                        due_date).to_invoice_input(contacts, companies)
-        for email, program, team_number, created_date, due_date
-        in zip(entries[EMAIL_COL], entries[PROGRAM_COL], entries[TEAM_NUMBER_COL], entries[CREATED_DATE_COL], entries[DUE_DATE_COL])
-    ])
+    return contacts, companies, products
 
-    invoices = create_invoices(api_client, invoice_hubspot_values)
-    if invoices is None:
-        print('Unable to generate the requested invoices')
-        return
 
-    # 6. Create all line items for invoices. Exit on error but report successes.
+def upload_rows(api_client: Client, entries: pandas.DataFrame, existing_invoices: dict[str, int], backend: str = BATCH_BACKEND) -> pandas.DataFrame:
+    '''Create the invoices and line items for the rows, reusing any invoice already recorded for a row's invoice group.'''
+    ids = lookup_ids(api_client, entries)
+    if ids is None:
+        return None
+    contacts, companies, products = ids
+
+    # 5. Parse all line items for invoices. Exit on error.
     line_item_inputs: list[LineItemInput] = None
     try:
         line_item_inputs = [
@@ -104,27 +89,236 @@ def main(file_path: str):
     except:
         print('Unable to parse line item entries from spreadsheet')
         print('Please check the errors above and try again')
-        return
+        return None
 
     if len(line_item_inputs) != entries.shape[0]:
         print('One or more line items did not translate correctly')
+        return None
+
+    # 6. Create all invoices as drafts, along with their line items when importing. Exit on error but report successes.
+    is_existing = entries[INVOICE_KEY_COL].isin(existing_invoices.keys())
+    invoice_hubspot_values = set([
+        InvoiceEntryRow(program, team_number, email, created_date,
+                        due_date).to_invoice_input(contacts, companies)
+        for email, program, team_number, created_date, due_date
+        in zip(entries[EMAIL_COL][~is_existing], entries[PROGRAM_COL][~is_existing], entries[TEAM_NUMBER_COL][~is_existing], entries[CREATED_DATE_COL][~is_existing], entries[DUE_DATE_COL][~is_existing])
+    ])
+
+    invoices: dict[InvoiceIdentifier, int] = {}
+    line_items: set[int] = set()
+    line_item_invoices: dict[int, int] = {}
+    pending_line_items = line_item_inputs
+    if len(invoice_hubspot_values) > 0 and backend == IMPORT_BACKEND:
+        imported = import_invoices(api_client, invoice_hubspot_values, [
+            x for x, existing in zip(line_item_inputs, is_existing) if not existing])
+        if imported is None:
+            print('Unable to import the requested invoices')
+            return None
+        invoices, line_item_invoices = imported
+        line_items = set(line_item_invoices.keys())
+        pending_line_items = [x for x, existing in zip(
+            line_item_inputs, is_existing) if existing]
+    elif len(invoice_hubspot_values) > 0:
+        invoices = create_invoices(api_client, invoice_hubspot_values)
+        if invoices is None:
+            print('Unable to generate the requested invoices')
+            return None
+
+    for invoice_key, line_item, existing in zip(entries[INVOICE_KEY_COL], line_item_inputs, is_existing):
+        if existing:
+            invoices[line_item.invoice_identifier()] = existing_invoices[invoice_key]
+
+    # 7. Create the remaining line items for invoices. Exit on error but report successes.
+    if len(pending_line_items) > 0:
+        pending_invoice_keys = set([x.invoice_identifier()
+                                   for x in pending_line_items])
+        created_line_items = create_line_items(api_client, pending_line_items, {
+            k: v for k, v in invoices.items() if k in pending_invoice_keys})
+        if created_line_items is None:
+            print('Unable to create the needed line items')
+            return None
+        line_items.update(created_line_items)
+
+    uploaded = entries.copy()
+    uploaded[INVOICE_ID_COL] = [invoices[x.invoice_identifier()]
+                                for x in line_item_inputs]
+    uploaded[PRODUCT_ID_COL] = [x.product for x in line_item_inputs]
+
+    uploaded[LINE_ITEM_ID_COL] = None
+    matches = match_line_item_ids(
+        api_client, line_items, line_item_inputs, invoices, line_item_invoices)
+    if matches is None:
+        print('Unable to pair the created line items with their rows. Please clear the invoices from HubSpot, check your data source, and try again')
+        return uploaded
+
+    line_item_ids = {v: k for k, v in matches.items()}
+    uploaded[LINE_ITEM_ID_COL] = [line_item_ids[x] for x in line_item_inputs]
+    return uploaded
+
+
+def finalize_recorded_invoices(api_client: Client, entries: pandas.DataFrame, manifest: dict, manifest_path: str) -> bool:
+    '''Move the recorded invoices for the rows from draft to open, retrying any a previous run could not finalize.'''
+    due_dates = entries.groupby(INVOICE_KEY_COL)[DUE_DATE_COL].first()
+    pending = {manifest[INVOICES_KEY][k]: k for k in due_dates.index
+               if k in manifest[INVOICES_KEY] and not manifest[FINALIZED_KEY].get(k)}
+    if len(pending) == 0:
+        return True
+
+    invoices = get_invoice_details(api_client, set(pending.keys()))
+    if invoices is None:
+        print('Unable to check which invoices are still drafts')
+        return False
+
+    # Invoices already out of draft were finalized by an earlier run or by hand, so only drafts are sent
+    drafts = set([k for k, v in invoices.items()
+                 if v.get('hs_invoice_status') == DRAFT_INVOICE_STATUS])
+    results = {k: True for k in invoices.keys() if k not in drafts}
+    if drafts:
+        results.update(finalize_invoices(api_client, {
+            invoice_id: {'hs_due_date': int(due_dates[pending[invoice_id]].timestamp() * 1000)}
+            for invoice_id in drafts
+        }))
+
+    for invoice_id, finalized in results.items():
+        manifest[FINALIZED_KEY][pending[invoice_id]] = finalized
+    write_manifest(manifest_path, manifest)
+    if not all(results.values()):
+        print('Unable to finalize every invoice. Run again with --delta --finalize to retry the remaining drafts')
+        return False
+    return True
+
+
+def main(file_path: str, delta: bool = False, manifest_path: str = None, finalize: bool = False, report_path: str = None, backend: str = BATCH_BACKEND, merge: bool = False, prune: bool = False):
+    '''Execute the sequence of steps to bulk-create invoices from the template spreadsheet.'''
+    if not os.path.isfile(file_path):
+        print('Provided file (', file_path, ') does not exist', sep='')
+        return
+
+    print('Beginning upload process...')
+
+    api_token = get_hubspot_api_token()
+    if api_token is None:
+        print('Could not retrieve HubSpot API token')
+        return
+
+    # 1. Parse all data in spreadsheet rows. Exit on error.
+    entries = get_rows(file_path)
+    if entries is None:
+        print('Unable to parse spreadsheet')
         return
+    if merge:
+        entries = merge_duplicate_rows(entries)
+    entries = add_row_keys(entries)
+
+    if manifest_path is None:
+        manifest_path = get_manifest_path(file_path)
+    manifest = empty_manifest()
+    if delta:
+        manifest = load_manifest(manifest_path)
+        if manifest is None:
+            print('Unable to run a delta upload. Run once without --delta to record an upload manifest')
+            return
+        if MERGED_KEY not in manifest:
+            print('The upload manifest does not record whether --merge was used. Run once without --delta to record a new upload manifest')
+            return
+        if manifest[MERGED_KEY] != merge:
+            print('The previous upload was run', 'with' if manifest[MERGED_KEY] else 'without',
+                  '--merge. Run the delta upload the same way')
+            return
+    elif os.path.isfile(manifest_path):
+        # A full upload creates every invoice again, so the previous records no longer describe this workbook
+        print('Replacing the upload manifest at', manifest_path)
+
+    api_client = Client.create(access_token=api_token)
+
+    new_entries, changed_entries = entries, entries.iloc[0:0]
+    if delta:
+        diff = diff_rows(entries, manifest)
+        if diff is None:
+            print('Unable to run a delta upload')
+            return
+        new_entries, changed_entries = diff
 
-    line_items = create_line_items(api_client, line_item_inputs, invoices)
-    if line_items is None:
-        print('Unable to create the needed line items')
+        removed = get_removed_lines(entries, manifest)
+        if prune and removed:
+            active_line_item_ids = get_active_line_item_ids(
+                api_client, set([v for v in removed.values() if v is not None]))
+            if active_line_item_ids is None:
+                print('Unable to confirm the removed line items are gone from HubSpot, so none were pruned')
+            else:
+                prune_removed_lines(manifest, removed, active_line_item_ids)
+
+        if new_entries.shape[0] == 0 and changed_entries.shape[0] == 0:
+            print('Nothing has changed since the previous upload')
+            if prune and removed:
+                save_manifest(manifest_path, manifest, changed_entries, merge)
+            if finalize:
+                finalize_recorded_invoices(
+                    api_client, entries, manifest, manifest_path)
+            if report_path is not None:
+                reconcile(api_client, entries, manifest, report_path)
+            return
+
+    # Only the rows changed since the previous upload need their line items updated
+    if changed_entries.shape[0] > 0:
+        updates = {
+            int(line_item_id): LineItemUpdate(int(qty), desc)
+            for line_item_id, qty, desc
+            in zip(changed_entries[LINE_ITEM_ID_COL], changed_entries[QUANTITY_COL].astype(int), changed_entries[DESCRIPTION_COL])
+        }
+        if update_line_items(api_client, updates) is None:
+            print('Unable to update the changed line items')
+            return
+
+    existing_invoices = manifest[INVOICES_KEY] if delta else {}
+    uploaded = new_entries.iloc[0:0]
+    if new_entries.shape[0] > 0:
+        uploaded = upload_rows(
+            api_client, new_entries, existing_invoices, backend)
+        if uploaded is None:
+            return
+    touched = pandas.concat([uploaded, changed_entries])
+    save_manifest(manifest_path, manifest, touched, merge)
+    if touched[LINE_ITEM_ID_COL].isna().any():
+        print('Bulk upload did not complete for the invoices listed below')
+        pprint(sorted(set(touched[INVOICE_ID_COL].astype(int))))
         return
 
     print('Bulk upload complete for the invoices listed below!')
-    pprint([x for x in invoices.values()])
+    pprint(sorted(set(touched[INVOICE_ID_COL].astype(int))))
+
+    # 8. Optionally move the recorded invoices out of draft, including any a previous run left behind.
+    if finalize:
+        finalize_recorded_invoices(
+            api_client, entries, manifest, manifest_path)
+
+    # 9. Optionally compare everything HubSpot now holds for the spreadsheet against its rows.
+    if report_path is not None:
+        reconcile(api_client, entries, manifest, report_path)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-f", "--file", dest="filepath",
                         help="path to file to read", metavar="FILE")
+    parser.add_argument("-d", "--delta", dest="delta", action="store_true",
+                        help="only upload rows added or changed since the previous run")
+    parser.add_argument("--prune", dest="prune", action="store_true",
+                        help="with --delta, stop tracking line items removed from the spreadsheet that HubSpot confirms are gone")
+    parser.add_argument("-m", "--manifest", dest="manifest", default=None,
+                        help="path to the upload manifest (default: one per workbook under ./manifests)", metavar="FILE")
+    parser.add_argument("--finalize", dest="finalize", action="store_true",
+                        help="move the workbook's invoices that are still drafts to open, retrying any a previous run could not finalize")
+    parser.add_argument("-r", "--reconcile", dest="report", default=None,
+                        help="write a per-invoice reconciliation report to REPORT", metavar="REPORT")
+    parser.add_argument("-b", "--backend", dest="backend", default=BATCH_BACKEND, choices=[BATCH_BACKEND, IMPORT_BACKEND],
+                        help="create records with batch calls, or with a single CRM import that replaces the create calls; "
+                        "either way every new line item is read back in batches of 100 to pair it with its row")
+    parser.add_argument("--merge", dest="merge", action="store_true",
+                        help="sum the quantities of rows with the same invoice, product, and description")
     args = parser.parse_args()
     if args.filepath is None:
         print('File path was not provided')
     else:
-        main(args.filepath)
+        main(args.filepath, args.delta, args.manifest,
+             args.finalize, args.report, args.backend, args.merge, args.prune)
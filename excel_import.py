@@ -118,3 +118,20 @@ def get_rows(file_path: str) -> pandas.DataFrame:
     print('Importing', df.shape[0], 'row(s)!')
 
     return df
+
+
+def merge_duplicate_rows(df: pandas.DataFrame) -> pandas.DataFrame:
+    '''Combine rows for the same product and description on the same invoice into one row'''
+    keys = [CREATED_DATE_COL, DUE_DATE_COL, PROGRAM_COL, TEAM_NUMBER_COL,
+            EMAIL_COL, SKU_COL, DESCRIPTION_COL]
+    merged = df.groupby(keys, sort=False, as_index=False).agg(
+        {QUANTITY_COL: 'sum', VALID_COL: 'first'})[df.columns]
+
+    saved = df.shape[0] - merged.shape[0]
+    if saved > 0:
+        print('Merged', df.shape[0], 'row(s) into', merged.shape[0],
+              'line item(s), saving', saved, 'HubSpot object(s)')
+    else:
+        print('No duplicate rows to merge')
+
+    return merged
@@ -0,0 +1,198 @@
+import csv
+from datetime import datetime, timezone
+import json
+import os
+from pprint import pprint
+import tempfile
+import time
+from hubspot import Client
+
+from api import batches, get_invoice_identifiers, get_invoice_line_item_ids
+from invoice_input import InvoiceIdentifier, InvoiceInput, LineItemInput
+
+# Custom unique-value invoice property the import uses to tell rows of the same invoice apart
+INVOICE_IMPORT_KEY_PROPERTY = 'bulk_invoice_import_key'
+
+IMPORT_FILE_NAME = 'invoices.csv'
+IMPORT_POLL_SECONDS = 5
+IMPORT_TIMEOUT_SECONDS = 30 * 60
+IMPORT_DONE_STATE = 'DONE'
+IMPORT_FAILED_STATES = set(['FAILED', 'CANCELED', 'REVERTED'])
+
+INVOICE_KEY_HEADER = 'Invoice Key'
+CURRENCY_HEADER = 'Currency'
+INVOICE_DATE_HEADER = 'Invoice Date'
+DUE_DATE_HEADER = 'Due Date'
+CONTACT_HEADER = 'Contact ID'
+COMPANY_HEADER = 'Company ID'
+QUANTITY_HEADER = 'Quantity'
+PRODUCT_HEADER = 'Product ID'
+DESCRIPTION_HEADER = 'Description'
+
+COLUMN_MAPPINGS = [
+    {'columnName': INVOICE_KEY_HEADER, 'columnObjectTypeId': '0-53',
+     'propertyName': INVOICE_IMPORT_KEY_PROPERTY, 'idColumnType': 'HUBSPOT_ALTERNATE_ID'},
+    {'columnName': CURRENCY_HEADER, 'columnObjectTypeId': '0-53',
+     'propertyName': 'hs_currency'},
+    {'columnName': INVOICE_DATE_HEADER, 'columnObjectTypeId': '0-53',
+     'propertyName': 'hs_invoice_date'},
+    {'columnName': DUE_DATE_HEADER, 'columnObjectTypeId': '0-53',
+     'propertyName': 'hs_due_date'},
+    {'columnName': CONTACT_HEADER, 'columnObjectTypeId': '0-1',
+     'propertyName': 'hs_object_id', 'idColumnType': 'HUBSPOT_OBJECT_ID'},
+    {'columnName': COMPANY_HEADER, 'columnObjectTypeId': '0-2',
+     'propertyName': 'hs_object_id', 'idColumnType': 'HUBSPOT_OBJECT_ID'},
+    {'columnName': QUANTITY_HEADER, 'columnObjectTypeId': '0-8',
+     'propertyName': 'quantity'},
+    {'columnName': PRODUCT_HEADER, 'columnObjectTypeId': '0-8',
+     'propertyName': 'hs_product_id'},
+    {'columnName': DESCRIPTION_HEADER, 'columnObjectTypeId': '0-8',
+     'propertyName': 'description'},
+]
+
+
+def to_import_date(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%d')
+
+
+def write_import_file(file_path: str, import_name: str, invoice_values: list[InvoiceInput], line_items: list[LineItemInput]) -> bool:
+    '''Write one CSV row per line item, carrying its invoice, contact, and company columns'''
+    invoice_lookup = {InvoiceIdentifier(int(x.contact), int(x.company)): x
+                      for x in invoice_values}
+    try:
+        with open(file_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([x['columnName'] for x in COLUMN_MAPPINGS])
+            for x in line_items:
+                invoice = invoice_lookup[x.invoice_identifier()]
+                writer.writerow([
+                    '{0}-{1}-{2}'.format(import_name,
+                                         invoice.contact, invoice.company),
+                    'USD',
+                    to_import_date(invoice.created_date),
+                    to_import_date(invoice.due_date),
+                    invoice.contact,
+                    invoice.company,
+                    x.quantity,
+                    x.product,
+                    x.description
+                ])
+    except:
+        print('Unable to write the import file. Check that every line item has an invoice')
+        return False
+    return True
+
+
+def wait_for_import(client: Client, import_id: str) -> bool:
+    '''Poll the import until HubSpot finishes processing it'''
+    waited = 0
+    while waited < IMPORT_TIMEOUT_SECONDS:
+        state = None
+        try:
+            state = client.crm.imports.core_api.get_by_id(import_id).state
+        except Exception as e:
+            pprint(e)
+            print('Unable to check the status of import', import_id)
+            return False
+
+        if state == IMPORT_DONE_STATE:
+            return True
+        if state in IMPORT_FAILED_STATES:
+            print('Import', import_id, 'finished as', state)
+            try:
+                pprint(client.crm.imports.public_imports_api.get_errors(
+                    import_id).results)
+            except:
+                print('Unable to retrieve the errors for import', import_id)
+            return False
+
+        print('Import', import_id, 'is', state, '...')
+        time.sleep(IMPORT_POLL_SECONDS)
+        waited += IMPORT_POLL_SECONDS
+
+    print('Gave up waiting on import', import_id, 'after',
+          IMPORT_TIMEOUT_SECONDS, 'seconds')
+    return False
+
+
+def get_imported_invoice_ids(client: Client, invoice_keys: list[str]) -> set[int]:
+    '''Using the unique import keys, find the Invoice IDs'''
+    invoice_ids: set[int] = set()
+    try:
+        for chunk in batches(invoice_keys):
+            api_response = client.crm.commerce.invoices.batch_api.read(
+                batch_read_input_simple_public_object_id={
+                    'idProperty': INVOICE_IMPORT_KEY_PROPERTY,
+                    'properties': [INVOICE_IMPORT_KEY_PROPERTY],
+                    'inputs': [{'id': x} for x in chunk]
+                })
+            invoice_ids.update([int(x.id)
+                               for x in api_response.results if not x.archived])
+    except Exception as e:
+        pprint(e)
+        print('Unable to query the imported Invoices from HubSpot')
+        return None
+    return invoice_ids
+
+
+def import_invoices(client: Client, invoice_values: list[InvoiceInput], line_items: list[LineItemInput]) -> tuple[dict[InvoiceIdentifier, int], dict[int, int]]:
+    '''Create the invoices and their line items through a single CRM import job, returning the line items mapped to their invoice.'''
+    print('Asking HubSpot to import the Invoices and Line Items...')
+    import_name = 'bulk-invoice-{0}'.format(
+        datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S'))
+    import_request = {
+        'name': import_name,
+        'dateFormat': 'YEAR_MONTH_DAY',
+        'files': [
+            {
+                'fileName': IMPORT_FILE_NAME,
+                'fileFormat': 'CSV',
+                'fileImportPage': {
+                    'hasHeader': True,
+                    'columnMappings': COLUMN_MAPPINGS
+                }
+            }
+        ]
+    }
+
+    import_id = None
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, IMPORT_FILE_NAME)
+        if not write_import_file(file_path, import_name, invoice_values, line_items):
+            return None
+
+        try:
+            import_id = client.crm.imports.core_api.create(
+                files=file_path, import_request=json.dumps(import_request)).id
+        except Exception as e:
+            pprint(e)
+            print('Unable to start the import in HubSpot')
+            return None
+
+    if not wait_for_import(client, import_id):
+        print('The import did not complete. Please clear the records from HubSpot, check your data source, and try again')
+        return None
+
+    invoice_keys = ['{0}-{1}-{2}'.format(import_name, x.contact, x.company)
+                    for x in invoice_values]
+    invoice_ids = get_imported_invoice_ids(client, invoice_keys)
+    if invoice_ids is None:
+        return None
+    if len(invoice_ids) != len(invoice_values):
+        print('One or more invoices was not imported. Please clear the records from HubSpot, check your data source, and try again')
+        return None
+
+    invoices = get_invoice_identifiers(client, invoice_ids)
+    if invoices is None:
+        return None
+
+    line_item_invoices = get_invoice_line_item_ids(client, invoice_ids)
+    if line_item_invoices is None:
+        return None
+    if len(line_item_invoices) != len(line_items):
+        print('One or more line items was not imported. Please clear the invoices from HubSpot, check your data source, and try again')
+        return None
+
+    print('Imported', len(invoices), 'Invoices and',
+          len(line_item_invoices), 'Line Items!')
+    return invoices, line_item_invoices
@@ -164,3 +164,17 @@ class InvoiceInput(object):
                 }
             ]
         }
+
+
+class LineItemUpdate(object):
+    def __init__(self, quantity: int, description: str):
+        self.__quantity = quantity
+        self.__description = description
+
+    @property
+    def quantity(self):
+        return self.__quantity
+
+    @property
+    def description(self):
+        return self.__description
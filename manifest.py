@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import pandas
+
+from excel_import import DESCRIPTION_COL, EMAIL_COL, PROGRAM_COL, QUANTITY_COL, SKU_COL, TEAM_NUMBER_COL
+
+MANIFEST_DIRECTORY = './manifests'
+MANIFEST_SUFFIX = '.manifest.json'
+
+INVOICE_KEY_COL = 'invoice_key'
+LINE_KEY_COL = 'line_key'
+FINGERPRINT_COL = 'fingerprint'
+INVOICE_ID_COL = 'invoice_id'
+LINE_ITEM_ID_COL = 'line_item_id'
+PRODUCT_ID_COL = 'product_id'
+
+INVOICES_KEY = 'invoices'
+LINE_ITEMS_KEY = 'line_items'
+MERGED_KEY = 'merged'
+FINALIZED_KEY = 'finalized'
+ID_KEY = 'id'
+PRODUCT_KEY = 'product'
+
+
+def add_row_keys(df: pandas.DataFrame) -> pandas.DataFrame:
+    '''Tag every row with its invoice group, line identity, and content fingerprint'''
+    df[INVOICE_KEY_COL] = df[EMAIL_COL].astype(str) + '|' + df[PROGRAM_COL].astype(str).str.upper() + \
+        '|' + df[TEAM_NUMBER_COL].astype(int).astype(str)
+    # The same SKU may appear more than once on an invoice, so number the repeats in sheet order
+    occurrence = df.groupby([INVOICE_KEY_COL, SKU_COL]).cumcount()
+    df[LINE_KEY_COL] = df[INVOICE_KEY_COL] + '|' + \
+        df[SKU_COL].astype(str) + '|' + occurrence.astype(str)
+    df[FINGERPRINT_COL] = (df[QUANTITY_COL].astype(int).astype(str) + '|' + df[DESCRIPTION_COL].astype(str)).map(
+        lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+    return df
+
+
+def get_manifest_path(file_path: str) -> str:
+    '''Each workbook keeps its own manifest, so one workbook's rows never look removed from another'''
+    workbook = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(MANIFEST_DIRECTORY, workbook + MANIFEST_SUFFIX)
+
+
+def empty_manifest() -> dict:
+    return {INVOICES_KEY: {}, LINE_ITEMS_KEY: {}, FINALIZED_KEY: {}}
+
+
+def load_manifest(manifest_path: str) -> dict:
+    '''Read the manifest saved by the previous successful run'''
+    if not os.path.isfile(manifest_path):
+        print('No upload manifest found at', manifest_path)
+        return None
+
+    manifest = None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except:
+        print('Unable to read upload manifest (', manifest_path, ')', sep='')
+        manifest = None
+
+    if manifest is None:
+        return None
+    if INVOICES_KEY not in manifest or LINE_ITEMS_KEY not in manifest:
+        print('Upload manifest (', manifest_path, ') is missing its invoice or line item records', sep='')
+        return None
+    # Manifests saved before finalizing was tracked have no record of it
+    manifest.setdefault(FINALIZED_KEY, {})
+
+    return manifest
+
+
+def save_manifest(manifest_path: str, manifest: dict, df: pandas.DataFrame, merged: bool) -> bool:
+    '''Record the HubSpot IDs and fingerprints of the uploaded rows on top of the previous manifest'''
+    # Line keys number repeated SKUs, so they only line up between runs that merged (or did not merge) the same way
+    manifest[MERGED_KEY] = merged
+    for invoice_key, invoice_id in zip(df[INVOICE_KEY_COL], df[INVOICE_ID_COL]):
+        manifest[INVOICES_KEY][invoice_key] = int(invoice_id)
+    # Changed rows are not looked up again, so they keep the product recorded when they were created
+    product_ids = df[PRODUCT_ID_COL] if PRODUCT_ID_COL in df.columns else pandas.Series(
+        None, index=df.index, dtype=object)
+    for line_key, fingerprint, line_item_id, product_id in zip(df[LINE_KEY_COL], df[FINGERPRINT_COL], df[LINE_ITEM_ID_COL], product_ids):
+        entry = manifest[LINE_ITEMS_KEY].setdefault(line_key, {})
+        # Line items created but never paired with their row are kept without an ID so --delta refuses to recreate them
+        entry[ID_KEY] = None if pandas.isna(line_item_id) else int(line_item_id)
+        entry[FINGERPRINT_COL] = fingerprint
+        if not pandas.isna(product_id):
+            entry[PRODUCT_KEY] = int(product_id)
+
+    return write_manifest(manifest_path, manifest)
+
+
+def write_manifest(manifest_path: str, manifest: dict) -> bool:
+    try:
+        directory = os.path.dirname(manifest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    except:
+        print('Unable to write upload manifest (', manifest_path, ')', sep='')
+        return False
+
+    print('Saved upload manifest to', manifest_path)
+    return True
+
+
+def get_removed_lines(df: pandas.DataFrame, manifest: dict) -> dict[str, int]:
+    '''Find the recorded line items whose rows are no longer in the spreadsheet'''
+    removed = set(manifest[LINE_ITEMS_KEY].keys()).difference(
+        set(df[LINE_KEY_COL]))
+    return {k: manifest[LINE_ITEMS_KEY][k][ID_KEY] for k in sorted(removed)}
+
+
+def get_line_invoice_key(line_key: str) -> str:
+    return line_key.rsplit('|', 2)[0]
+
+
+def prune_removed_lines(manifest: dict, removed: dict[str, int], active_line_item_ids: set[int]):
+    '''Stop tracking removed line items that HubSpot confirms are gone or archived'''
+    still_billed = {k: v for k, v in removed.items()
+                    if v in active_line_item_ids}
+    for line_key in removed.keys():
+        if line_key not in still_billed:
+            del manifest[LINE_ITEMS_KEY][line_key]
+    print('Pruned', len(removed) - len(still_billed),
+          'removed line item(s) from the upload manifest')
+    if still_billed:
+        print(len(still_billed), 'removed line item(s) are still active in HubSpot and were kept:')
+        print('\n'.join(['\t{0} (line item {1})'.format(k, v)
+              for k, v in still_billed.items()]))
+
+
+def diff_rows(df: pandas.DataFrame, manifest: dict) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    '''Split the rows into those never uploaded and those uploaded with a different quantity or description'''
+    recorded = manifest[LINE_ITEMS_KEY]
+    unmatched = sorted([k for k, v in recorded.items() if v[ID_KEY] is None])
+    if unmatched:
+        print(len(unmatched), 'line item(s) from a previous upload were created in HubSpot but never paired with their rows:')
+        print('\n'.join(['\t{0}'.format(x) for x in unmatched]))
+        print('Please clear those invoices from HubSpot, delete the upload manifest, and upload again without --delta')
+        return None
+
+    line_item_ids = df[LINE_KEY_COL].map(
+        {k: v[ID_KEY] for k, v in recorded.items()})
+    fingerprints = df[LINE_KEY_COL].map(
+        {k: v[FINGERPRINT_COL] for k, v in recorded.items()})
+
+    is_new = line_item_ids.isna()
+    is_changed = ~is_new & (fingerprints != df[FINGERPRINT_COL])
+
+    new_rows = df[is_new].copy()
+    changed_rows = df[is_changed].copy()
+    changed_rows[LINE_ITEM_ID_COL] = line_item_ids[is_changed].astype(int)
+    changed_rows[INVOICE_ID_COL] = changed_rows[INVOICE_KEY_COL].map(
+        manifest[INVOICES_KEY]).astype(int)
+
+    removed = get_removed_lines(df, manifest)
+    if removed:
+        print(len(removed), 'previously uploaded line item(s) are no longer in the spreadsheet but are STILL BILLED in HubSpot:')
+        print('\n'.join(['\t{0} (line item {1})'.format(k, v)
+              for k, v in removed.items()]))
+        print('Remove them from their invoices in HubSpot, then run with --delta --prune to stop tracking them')
+
+    print('Found', new_rows.shape[0], 'new row(s) and',
+          changed_rows.shape[0], 'changed row(s)')
+    return new_rows, changed_rows
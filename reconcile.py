@@ -0,0 +1,139 @@
+import pandas
+from hubspot import Client
+
+from api import get_invoice_details, get_invoice_line_item_ids, get_line_item_details
+from excel_import import DESCRIPTION_COL, DUE_DATE_COL, QUANTITY_COL, SKU_COL
+from manifest import ID_KEY, INVOICE_ID_COL, INVOICE_KEY_COL, INVOICES_KEY, LINE_ITEM_ID_COL, LINE_ITEMS_KEY, LINE_KEY_COL, PRODUCT_ID_COL, PRODUCT_KEY, get_line_invoice_key, get_removed_lines
+
+AMOUNT_COL = 'amount'
+STATUS_COL = 'status'
+
+EXPECTED_SUFFIX = '_expected'
+HUBSPOT_SUFFIX = '_hubspot'
+
+
+def get_hubspot_lines(client: Client, invoice_ids: set[int]) -> pandas.DataFrame:
+    '''Batch-read every line item on the invoices into one row per line item'''
+    line_item_invoices = get_invoice_line_item_ids(client, invoice_ids)
+    if line_item_invoices is None:
+        return None
+
+    details = get_line_item_details(
+        client, set(line_item_invoices.keys()), line_item_invoices)
+    if details is None:
+        return None
+
+    lines = pandas.DataFrame.from_dict(details, orient='index')
+    lines = lines.reindex(
+        columns=['invoice', 'hs_product_id', 'hs_sku', 'quantity', 'description', 'amount'])
+    lines.columns = [INVOICE_ID_COL, PRODUCT_ID_COL, SKU_COL,
+                     QUANTITY_COL, DESCRIPTION_COL, AMOUNT_COL]
+    lines.index.name = LINE_ITEM_ID_COL
+    lines = lines.reset_index()
+    lines[LINE_ITEM_ID_COL] = lines[LINE_ITEM_ID_COL].astype('Int64')
+    lines[INVOICE_ID_COL] = lines[INVOICE_ID_COL].astype('Int64')
+    lines[PRODUCT_ID_COL] = pandas.to_numeric(
+        lines[PRODUCT_ID_COL]).astype('Int64')
+    lines[QUANTITY_COL] = pandas.to_numeric(lines[QUANTITY_COL])
+    lines[AMOUNT_COL] = pandas.to_numeric(lines[AMOUNT_COL])
+    lines[DESCRIPTION_COL] = lines[DESCRIPTION_COL].fillna('').astype(str)
+    lines[SKU_COL] = lines[SKU_COL].fillna('').astype(str)
+    return lines
+
+
+def to_due_date(value: str):
+    '''HubSpot returns dates either as ISO strings or as epoch milliseconds'''
+    if value is None or value == '':
+        return None
+    if str(value).isdigit():
+        return pandas.to_datetime(int(value), unit='ms', utc=True).date()
+    return pandas.to_datetime(value, utc=True).date()
+
+
+def reconcile(client: Client, entries: pandas.DataFrame, manifest: dict, report_path: str) -> pandas.DataFrame:
+    '''Compare the spreadsheet rows with what HubSpot holds for their invoices and write a per-invoice report'''
+    print('Reconciling spreadsheet with HubSpot...')
+    expected = entries[[INVOICE_KEY_COL, LINE_KEY_COL, SKU_COL,
+                        QUANTITY_COL, DESCRIPTION_COL, DUE_DATE_COL]].copy()
+    expected[INVOICE_ID_COL] = expected[INVOICE_KEY_COL].map(
+        manifest[INVOICES_KEY]).astype('Int64')
+    expected[LINE_ITEM_ID_COL] = expected[LINE_KEY_COL].map(
+        {k: v[ID_KEY] for k, v in manifest[LINE_ITEMS_KEY].items()}).astype('Int64')
+    expected[PRODUCT_ID_COL] = expected[LINE_KEY_COL].map(
+        {k: v.get(PRODUCT_KEY) for k, v in manifest[LINE_ITEMS_KEY].items()}).astype('Int64')
+    expected[SKU_COL] = expected[SKU_COL].astype(str)
+    expected[DESCRIPTION_COL] = expected[DESCRIPTION_COL].astype(str)
+
+    not_uploaded = expected[INVOICE_ID_COL].isna()
+    if not_uploaded.any():
+        print(not_uploaded.sum(), 'row(s) have no recorded invoice and are left out of the report')
+        expected = expected[~not_uploaded]
+    # Lines dropped from the spreadsheet since they were uploaded stay on their invoices until someone removes them
+    removed = get_removed_lines(entries, manifest)
+    removed_ids = set([v for v in removed.values() if v is not None])
+    removed_invoice_ids = set([manifest[INVOICES_KEY][get_line_invoice_key(k)] for k in removed.keys()
+                               if get_line_invoice_key(k) in manifest[INVOICES_KEY]])
+
+    if expected.shape[0] == 0 and len(removed_invoice_ids) == 0:
+        print('No uploaded rows to reconcile')
+        return None
+
+    invoice_ids = set(expected[INVOICE_ID_COL].astype(int)).union(removed_invoice_ids)
+    invoices = get_invoice_details(client, invoice_ids)
+    if invoices is None:
+        return None
+    actual = get_hubspot_lines(client, invoice_ids)
+    if actual is None:
+        return None
+
+    lines = expected.merge(actual, on=LINE_ITEM_ID_COL, how='outer',
+                           suffixes=(EXPECTED_SUFFIX, HUBSPOT_SUFFIX), indicator=True)
+    lines[INVOICE_ID_COL] = lines[INVOICE_ID_COL + EXPECTED_SUFFIX].fillna(
+        lines[INVOICE_ID_COL + HUBSPOT_SUFFIX])
+    is_missing = lines['_merge'] == 'left_only'
+    is_removed = (lines['_merge'] == 'right_only') & lines[LINE_ITEM_ID_COL].isin(
+        removed_ids)
+    is_extra = (lines['_merge'] == 'right_only') & ~is_removed
+    is_mismatched = (lines['_merge'] == 'both') & (
+        (lines[QUANTITY_COL + EXPECTED_SUFFIX] != lines[QUANTITY_COL + HUBSPOT_SUFFIX]) |
+        (lines[SKU_COL + EXPECTED_SUFFIX] != lines[SKU_COL + HUBSPOT_SUFFIX]) |
+        (lines[DESCRIPTION_COL + EXPECTED_SUFFIX] != lines[DESCRIPTION_COL + HUBSPOT_SUFFIX]) |
+        (lines[INVOICE_ID_COL + EXPECTED_SUFFIX] != lines[INVOICE_ID_COL + HUBSPOT_SUFFIX]))
+    # The same SKU exists once per program, so only the product ID proves the line bills the right product
+    is_wrong_product = (lines['_merge'] == 'both') & (
+        lines[PRODUCT_ID_COL + EXPECTED_SUFFIX] != lines[PRODUCT_ID_COL + HUBSPOT_SUFFIX]).fillna(False)
+    lines = lines.assign(missing=is_missing, extra=is_extra, removed=is_removed, mismatched=is_mismatched,
+                         wrong_product=is_wrong_product, expected=lines['_merge'] != 'right_only', hubspot=~is_missing)
+
+    report = lines.groupby(INVOICE_ID_COL).agg(
+        expected_lines=('expected', 'sum'),
+        hubspot_lines=('hubspot', 'sum'),
+        missing_lines=('missing', 'sum'),
+        extra_lines=('extra', 'sum'),
+        removed_lines_still_billed=('removed', 'sum'),
+        mismatched_lines=('mismatched', 'sum'),
+        wrong_product_lines=('wrong_product', 'sum'),
+        expected_quantity=(QUANTITY_COL + EXPECTED_SUFFIX, 'sum'),
+        hubspot_quantity=(QUANTITY_COL + HUBSPOT_SUFFIX, 'sum'),
+        hubspot_amount=(AMOUNT_COL, 'sum'))
+    report.insert(0, INVOICE_KEY_COL, report.index.map(
+        {v: k for k, v in manifest[INVOICES_KEY].items()}))
+    report.insert(1, STATUS_COL, report.index.map(
+        {k: v.get('hs_invoice_status') for k, v in invoices.items()}))
+    report['expected_due_date'] = report.index.map(expected.groupby(INVOICE_ID_COL)[
+        DUE_DATE_COL].first().dt.date)
+    report['hubspot_due_date'] = report.index.map(
+        {k: to_due_date(v.get('hs_due_date')) for k, v in invoices.items()})
+    report['due_date_matches'] = report['expected_due_date'] == report['hubspot_due_date']
+    report['ok'] = (report['missing_lines'] == 0) & (report['extra_lines'] == 0) & (report['removed_lines_still_billed'] == 0) & (
+        report['mismatched_lines'] == 0) & (report['wrong_product_lines'] == 0) & report['due_date_matches']
+
+    try:
+        report.to_csv(report_path)
+    except:
+        print('Unable to write reconciliation report (', report_path, ')', sep='')
+        return None
+
+    print('Reconciled', lines.shape[0], 'line item(s) across', report.shape[0], 'invoice(s):',
+          (~report['ok']).sum(), 'invoice(s) differ. See', report_path)
+    return report
@@ -0,0 +1,224 @@
+import csv
+import itertools
+import json
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+import import_api
+from api import BATCH_LIMIT, create_invoices, create_line_items
+from import_api import COLUMN_MAPPINGS, IMPORT_FILE_NAME, INVOICE_IMPORT_KEY_PROPERTY, import_invoices
+from invoice_input import InvoiceIdentifier, InvoiceInput, LineItemInput
+
+
+class FakeAssociation(object):
+    def __init__(self, from_id: int, to_ids: list[int]):
+        self.from_id = from_id
+        self.to_ids = to_ids
+
+    def to_dict(self) -> dict:
+        return {'_from': {'id': str(self.from_id)}, 'to': [{'id': str(x)} for x in self.to_ids]}
+
+
+class FakeHubSpot(object):
+    '''Local stand-in for the HubSpot endpoints the invoice backends call'''
+
+    def __init__(self, import_states: list[str] = None):
+        self.ids = itertools.count(1000)
+        self.invoices: dict[int, dict] = {}
+        self.line_items: dict[int, dict] = {}
+        self.import_states = iter(import_states or ['DONE'])
+        self.import_requests: list[dict] = []
+        self.import_rows: list[list[str]] = []
+        self.status_checks = 0
+        self.error_checks = []
+        self.association_reads: list[int] = []
+
+        batch_api = SimpleNamespace(
+            create=self.create_invoices, read=self.read_invoices)
+        self.crm = SimpleNamespace(
+            imports=SimpleNamespace(
+                core_api=SimpleNamespace(
+                    create=self.create_import, get_by_id=self.get_import),
+                public_imports_api=SimpleNamespace(get_errors=self.get_import_errors)),
+            commerce=SimpleNamespace(
+                invoices=SimpleNamespace(batch_api=batch_api)),
+            line_items=SimpleNamespace(batch_api=SimpleNamespace(
+                create=self.create_line_items)),
+            associations=SimpleNamespace(batch_api=SimpleNamespace(read=self.read_associations)))
+
+    def add_invoice(self, properties: dict, contact: int, company: int) -> int:
+        invoice_id = next(self.ids)
+        self.invoices[invoice_id] = {
+            'properties': properties, 'contact': contact, 'company': company}
+        return invoice_id
+
+    def add_line_item(self, properties: dict, invoice_id: int) -> int:
+        line_item_id = next(self.ids)
+        self.line_items[line_item_id] = {
+            'properties': properties, 'invoice': invoice_id}
+        return line_item_id
+
+    def create_import(self, files: str, import_request: str):
+        request = json.loads(import_request)
+        self.import_requests.append(request)
+        with open(files, newline='') as f:
+            self.import_rows = list(csv.reader(f))
+
+        mappings = request['files'][0]['fileImportPage']['columnMappings']
+        columns = [(x['columnObjectTypeId'], x['propertyName'])
+                   for x in mappings]
+        invoice_keys: dict[str, int] = {}
+        for row in self.import_rows[1:]:
+            values = dict(zip(columns, row))
+            invoice_key = values[('0-53', INVOICE_IMPORT_KEY_PROPERTY)]
+            if invoice_key not in invoice_keys:
+                invoice_keys[invoice_key] = self.add_invoice(
+                    {k[1]: v for k, v in values.items() if k[0] == '0-53'},
+                    int(values[('0-1', 'hs_object_id')]), int(values[('0-2', 'hs_object_id')]))
+            self.add_line_item({k[1]: v for k, v in values.items() if k[0] == '0-8'},
+                               invoice_keys[invoice_key])
+        return SimpleNamespace(id='42')
+
+    def get_import(self, import_id: str):
+        self.status_checks += 1
+        return SimpleNamespace(id=import_id, state=next(self.import_states))
+
+    def get_import_errors(self, import_id: str):
+        self.error_checks.append(import_id)
+        return SimpleNamespace(results=[{'errorType': 'INVALID_OBJECT_ID'}])
+
+    def create_invoices(self, batch_input_simple_public_object_batch_input_for_create: dict):
+        results = []
+        for x in batch_input_simple_public_object_batch_input_for_create['inputs']:
+            invoice_id = self.add_invoice(x['properties'], int(x['associations'][0]['to']['id']),
+                                          int(x['associations'][1]['to']['id']))
+            results.append(SimpleNamespace(id=str(invoice_id),
+                           properties=x['properties'], archived=False))
+        return SimpleNamespace(results=results)
+
+    def read_invoices(self, batch_read_input_simple_public_object_id: dict):
+        body = batch_read_input_simple_public_object_id
+        keys = set([x['id'] for x in body['inputs']])
+        return SimpleNamespace(results=[
+            SimpleNamespace(id=str(k), properties=v['properties'], archived=False)
+            for k, v in self.invoices.items() if v['properties'].get(body['idProperty']) in keys
+        ])
+
+    def create_line_items(self, batch_input_simple_public_object_batch_input_for_create: dict):
+        results = []
+        for x in batch_input_simple_public_object_batch_input_for_create['inputs']:
+            line_item_id = self.add_line_item(
+                x['properties'], int(x['associations'][0]['to']['id']))
+            results.append(SimpleNamespace(id=str(line_item_id),
+                           properties=x['properties'], archived=False))
+        return SimpleNamespace(results=results)
+
+    def read_associations(self, from_type: str, to_type: str, batch_input_public_object_id: dict):
+        self.association_reads.append(
+            len(batch_input_public_object_id['inputs']))
+        results = []
+        for x in batch_input_public_object_id['inputs']:
+            object_id = int(x['id'])
+            if (from_type, to_type) == ('0-53', '0-1'):
+                to_ids = [self.invoices[object_id]['contact']]
+            elif (from_type, to_type) == ('0-53', '0-2'):
+                to_ids = [self.invoices[object_id]['company']]
+            else:
+                to_ids = [k for k, v in self.line_items.items()
+                          if v['invoice'] == object_id]
+            results.append(FakeAssociation(object_id, to_ids))
+        return SimpleNamespace(results=results)
+
+
+CREATED_DATE = 1748754000000  # 2025-06-01 America/Chicago
+DUE_DATE = 1751346000000  # 2025-07-01 America/Chicago
+
+
+class ImportInvoicesTest(unittest.TestCase):
+    def setUp(self):
+        self.invoice_values = [InvoiceInput(1, 11, CREATED_DATE, DUE_DATE),
+                               InvoiceInput(2, 12, CREATED_DATE, DUE_DATE)]
+        self.line_items = [LineItemInput(1, 11, 2, 'Kit', 501),
+                           LineItemInput(1, 11, 1, '', 502),
+                           LineItemInput(2, 12, 3, 'Kit', 501)]
+        patcher = mock.patch.object(import_api.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_writes_one_row_per_line_item_with_mappings(self):
+        client = FakeHubSpot()
+        self.assertIsNotNone(import_invoices(
+            client, self.invoice_values, self.line_items))
+
+        request = client.import_requests[0]
+        self.assertEqual(request['dateFormat'], 'YEAR_MONTH_DAY')
+        self.assertEqual(request['files'][0]['fileName'], IMPORT_FILE_NAME)
+        self.assertEqual(
+            request['files'][0]['fileImportPage']['columnMappings'], COLUMN_MAPPINGS)
+
+        header, *rows = client.import_rows
+        self.assertEqual(header, [x['columnName'] for x in COLUMN_MAPPINGS])
+        self.assertEqual([x[1:] for x in rows], [
+            ['USD', '2025-06-01', '2025-07-01', '1', '11', '2', '501', 'Kit'],
+            ['USD', '2025-06-01', '2025-07-01', '1', '11', '1', '502', ''],
+            ['USD', '2025-06-01', '2025-07-01', '2', '12', '3', '501', 'Kit'],
+        ])
+        self.assertEqual(rows[0][0], rows[1][0])
+        self.assertNotEqual(rows[0][0], rows[2][0])
+        self.assertTrue(rows[0][0].startswith(request['name']))
+
+    def test_polls_until_done(self):
+        client = FakeHubSpot(['STARTED', 'PROCESSING', 'DONE'])
+        self.assertIsNotNone(import_invoices(
+            client, self.invoice_values, self.line_items))
+        self.assertEqual(client.status_checks, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(client.error_checks, [])
+
+    def test_failed_import_reports_errors(self):
+        client = FakeHubSpot(['STARTED', 'FAILED'])
+        self.assertIsNone(import_invoices(
+            client, self.invoice_values, self.line_items))
+        self.assertEqual(client.status_checks, 2)
+        self.assertEqual(client.error_checks, ['42'])
+
+    def test_returns_same_structures_as_batch_backend(self):
+        imported_client = FakeHubSpot()
+        invoices, line_item_invoices = import_invoices(
+            imported_client, self.invoice_values, self.line_items)
+
+        batch_client = FakeHubSpot()
+        batch_invoices = create_invoices(batch_client, self.invoice_values)
+        batch_line_items = create_line_items(
+            batch_client, self.line_items, batch_invoices)
+
+        self.assertEqual(set(invoices.keys()), set(batch_invoices.keys()))
+        self.assertEqual(set(invoices.keys()), set(
+            [InvoiceIdentifier(1, 11), InvoiceIdentifier(2, 12)]))
+        self.assertEqual(len(line_item_invoices), len(batch_line_items))
+        self.assertEqual(set(line_item_invoices.keys()),
+                         set(imported_client.line_items.keys()))
+        for line_item_id, invoice_id in line_item_invoices.items():
+            self.assertEqual(
+                imported_client.line_items[line_item_id]['invoice'], invoice_id)
+        self.assertEqual(set(line_item_invoices.values()),
+                         set(invoices.values()))
+
+    def test_association_reads_stay_within_batch_limit(self):
+        invoice_values = [InvoiceInput(x, 10000 + x, CREATED_DATE, DUE_DATE)
+                          for x in range(BATCH_LIMIT + 50)]
+        line_items = [LineItemInput(x, 10000 + x, 1, '', 501)
+                      for x in range(BATCH_LIMIT + 50)]
+        client = FakeHubSpot()
+        invoices, line_item_invoices = import_invoices(
+            client, invoice_values, line_items)
+
+        self.assertEqual(len(invoices), len(invoice_values))
+        self.assertEqual(len(line_item_invoices), len(line_items))
+        self.assertTrue(client.association_reads)
+        self.assertLessEqual(max(client.association_reads), BATCH_LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()